@@ -14,6 +14,7 @@ from __future__ import absolute_import, division, print_function, \
 from camkes.internal.seven import cmp, filter, map, zip
 
 from camkes.ast import Composition, Instance, Parameter, Struct
+from camkes.internal.memoization import memoize
 from camkes.templates import TemplateError
 from capdl import ASIDPool, CNode, Endpoint, Frame, IODevice, IOPageTable, \
     Notification, page_sizes, PageDirectory, PageTable, TCB, Untyped, \
@@ -21,12 +22,13 @@ from capdl import ASIDPool, CNode, Endpoint, Frame, IODevice, IOPageTable, \
 from capdl.util import ctz
 from capdl.Object import get_libsel4_constant
 import collections
-import math
+import itertools
 import os
 import platform
 import re
 import six
 import numbers
+import weakref
 
 from camkes.templates.arch_helpers import min_untyped_size, max_untyped_size, \
     is_arch_arm
@@ -59,7 +61,9 @@ def ipc_buffer_address(sym):
 
 
 def shared_buffer_symbol(sym, shmem_size, page_size):
-    page_size_bits = int(math.log(page_size, 2))
+    # Page sizes are always powers of two.
+    assert page_size > 0 and page_size & (page_size - 1) == 0
+    page_size_bits = ctz(page_size)
     return '''
 struct {
     char content[ROUND_UP_UNSAFE(%(shmem_size)s, %(page_size)s)];
@@ -71,14 +75,29 @@ struct {
 ''' % {"sym": sym, "shmem_size": shmem_size, "page_size": page_size, "page_size_bits": page_size_bits}
 
 
+@memoize()
+def arch_page_sizes(arch):
+    '''
+    Returns the page sizes of an architecture in ascending order. This is
+    cached as the page size macros are called many times for the same
+    architecture.
+    '''
+    return tuple(page_sizes(arch))
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('arch_page_sizes')
+
+
 def next_page_multiple(size, arch):
     '''
     Finds the smallest multiple of 4K that can comfortably be used to create
     a mapping for the provided size on a given architecture.
     '''
-    multiple = page_sizes(arch)[0]
-    while size > multiple:
-        multiple += 4096
+    multiple = arch_page_sizes(arch)[0]
+    if size > multiple:
+        # Round the excess up to the next 4K boundary.
+        multiple += (size - multiple + 4095) // 4096 * 4096
     return multiple
 
 
@@ -86,32 +105,37 @@ def next_page_multiple(size, arch):
 next_page_multiple.__annotations__ = {'size': int, 'arch': str, 'return': int}
 
 
+@memoize()
+def page_align_mask(arch):
+    '''Returns a mask that clears the offset within the smallest page.'''
+    return ~(arch_page_sizes(arch)[0] - 1)
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('page_align_mask')
+
+
 def align_page_address(address, arch):
-    page_size = page_sizes(arch)[0]
-    return address & ~(page_size-1)
+    return address & page_align_mask(arch)
 
 
 def get_untypeds_from_range(start, size):
     """
     Returns a list of untypeds covering a range with the correct alignments.
     """
-    def get_alignment_bits(addr):
-        return ctz(addr)
-
     remaining = size
     current = start
     uts = []
     while remaining > 0:
-        current_alignment = 2 ** get_alignment_bits(current)
-        ut_size = current_alignment
-        while ut_size > 0:
-            if ut_size <= remaining:
-                break
-            ut_size //= 2
-
-        uts.append((current, get_alignment_bits(ut_size)))
-        current += ut_size
-        remaining -= ut_size
+        # The untyped must be aligned to its size and no larger than what is
+        # left of the range. An address of 0 is aligned to any size.
+        max_size_bits = remaining.bit_length() - 1
+        size_bits = min(ctz(current), max_size_bits) if current \
+            else max_size_bits
+
+        uts.append((current, size_bits))
+        current += 1 << size_bits
+        remaining -= 1 << size_bits
     return uts
 
 
@@ -125,13 +149,21 @@ def get_page_size(size, arch):
     a mapping for the provided size on a given architecture. It assumes
     that the variable will be aligned to the start of the frame.
     '''
-    frame_size = 0
     size = int(size)
-    for sz in reversed(page_sizes(arch)):
-        if size >= sz and size % sz == 0:
-            frame_size = sz
-            break
-    return frame_size
+    if size > 0:
+        # Page sizes are powers of two, so a positive size is a multiple of
+        # one exactly when none of the bits below it are set.
+        for sz in reversed(arch_page_sizes(arch)):
+            if size & (sz - 1) == 0:
+                return sz
+    return 0
+
+
+# Every string matching '^R?W?X?P?$'.
+_VALID_PERMS = frozenset([
+    '', 'P', 'X', 'XP', 'W', 'WP', 'WX', 'WXP',
+    'R', 'RP', 'RX', 'RXP', 'RW', 'RWP', 'RWX', 'RWXP',
+])
 
 
 def get_perm(configuration, instance_name, interface_name):
@@ -139,53 +171,59 @@ def get_perm(configuration, instance_name, interface_name):
     perm = configuration[instance_name].get('%s_access' % interface_name)
     if not perm:
         perm = "RWXP"
-    elif not re.match('^R?W?X?P?$', perm):
+    elif perm not in _VALID_PERMS:
         raise(TemplateError('invalid permissions attribute %s.%s_access' %
                             (instance_name, interface_name)))
     return perm
 
 
+# C types for the CAmkES primitive types that are not spelt the same in C.
+_C_TYPES = {
+    'string': 'char *',
+    'character': 'char',
+    'boolean': 'bool',
+}
+
+
 def show_type(t):
     assert isinstance(t, (six.string_types, Struct))
     if isinstance(t, six.string_types):
-        if t == 'string':
-            return 'char *'
-        elif t == 'character':
-            return 'char'
-        elif t == 'boolean':
-            return 'bool'
-        else:
-            return t
+        return _C_TYPES.get(t, t)
     else:
         return "struct " + t.name
 
 
+# The type to use for a value, indexed by the number of bytes needed to hold
+# one less than the value.
+_FIT_INTEGER_TYPES = ('uint8_t', 'uint8_t', 'uint16_t', 'uint32_t', 'uint32_t',
+                      'uint64_t', 'uint64_t', 'uint64_t', 'uint64_t')
+
+
 def type_to_fit_integer(value):
     assert isinstance(value, six.integer_types)
-    if value <= 2 ** 8:
-        return 'uint8_t'
-    elif value <= 2 ** 16:
-        return 'uint16_t'
-    elif value <= 2 ** 32:
-        return 'uint32_t'
-    elif value <= 2 ** 64:
-        return 'uint64_t'
-    else:
+    size = (max(value - 1, 0).bit_length() + 7) // 8
+    if size >= len(_FIT_INTEGER_TYPES):
         raise Exception('No type to fit value %s' % value)
+    return _FIT_INTEGER_TYPES[size]
 
 
 def print_type_definitions(attributes, values):
     def print_struct_definition(struct, sub_value):
-        return_string = "struct %s {\n" % struct.name
+        parts = ["struct %s {\n" % struct.name]
         for i in struct.attributes:
             array_string = ""
             if i.array:
                 array_string = "[%d]" % (len(sub_value.get(i.name)) if sub_value else 0)
-            return_string += "%s %s%s;\n" % (show_type(i.type), i.name, array_string)
-        return return_string + "};\n"
+            parts.append("%s %s%s;\n" % (show_type(i.type), i.name, array_string))
+        parts.append("};\n")
+        return ''.join(parts)
 
     def recurse_structs(attribute, values):
         struct = attribute.type
+        if struct.name in already_drawn:
+            # Only the first occurrence of a struct is drawn, and the structs it
+            # contains were found along with it, so there is nothing to do.
+            return []
         structs = []
         for sub_attribute in struct.attributes:
             if isinstance(sub_attribute.type, Struct):
@@ -194,21 +232,17 @@ def print_type_definitions(attributes, values):
         if attribute.array:
             values = values[0] if values else None
         structs.append((struct, values))
+        already_drawn.add(struct.name)
         return structs
 
-    return_string = ""
     structs = []
+    already_drawn = set()
     for attribute in attributes:
         if isinstance(attribute.type, Struct):
             structs.extend(recurse_structs(attribute, values.get(attribute.name)))
 
-    already_drawn = dict()
-    for (struct, sub_value) in structs:
-        if struct.name not in already_drawn:
-            return_string += str(print_struct_definition(struct, sub_value))
-            already_drawn[struct.name] = 1
-
-    return return_string
+    return ''.join(print_struct_definition(struct, sub_value)
+                   for (struct, sub_value) in structs)
 
 
 def show_attribute_value(t, value):
@@ -216,52 +250,72 @@ def show_attribute_value(t, value):
         An attriubte can be an array (although this is provided to the template as a tuple type)
         An attribute can also be a camkes structure which is a dictionary of attributes (keys) with corresponding values
     """
-    return_string = ""
+    parts = []
     is_array = False
     if isinstance(value, (tuple, list)):
         is_array = True
         values = value
-        return_string += "{\\\n"
+        parts.append("{\\\n")
     else:
         values = (value,)
 
     # runs for every element in the array, if a non array attribute then this just runs once.
     for i, value in enumerate(values):
         if isinstance(value, six.string_types):  # For string literals
-            return_string += "\"%s\"" % value
+            parts.append("\"%s\"" % value)
         elif isinstance(t.type, Struct):  # For struct attributes (This recursively calls this function)
-            return_string += "{\\\n"
+            parts.append("{\\\n")
             for attribute in t.type.attributes:
-                return_string += "." + str(attribute.name)  # + ("[]" if attribute.array else "")
-                return_string += " = " + \
-                    str(show_attribute_value(attribute, value[attribute.name])) + ",\\\n"
-            return_string += "}"
+                parts.append("." + str(attribute.name))  # + ("[]" if attribute.array else "")
+                parts.append(" = ")
+                parts.append(show_attribute_value(attribute, value[attribute.name]))
+                parts.append(",\\\n")
+            parts.append("}")
         else:  # For all other literal types
-            return_string += "%s" % str(value)
+            parts.append("%s" % str(value))
 
         # Add comma if element is part of an array
         if i < (len(values)-1):
-            return_string += ",\\\n"
+            parts.append(",\\\n")
     if is_array:
-        return_string += "}"
-    return return_string
+        parts.append("}")
+    return ''.join(parts)
 
 
 def show_includes(xs, prefix=''):
-    s = ''
+    includes = []
     for header in xs:
         if header.relative:
-            s += '#include "%(prefix)s%(source)s"\n' % {
+            includes.append('#include "%(prefix)s%(source)s"\n' % {
                 'prefix': prefix,
                 'source': header.source,
-            }
+            })
         else:
-            s += '#include <%s>\n' % header.source
-    return s
+            includes.append('#include <%s>\n' % header.source)
+    return ''.join(includes)
 
 
 PAGE_SIZE = 4096
 
+# Characters that cannot appear in a C identifier derived from an instance name.
+_NON_IDENTIFIER_CHARS = re.compile(r'[^A-Za-z0-9]')
+
+
+class Thread(object):
+    '''A thread of a component instance. See `threads` for the fields.'''
+    __slots__ = ('name', 'interface', 'intra_index', 'stack_symbol',
+                 'stack_size', 'ipc_symbol', 'sp', 'addr')
+
+    def __init__(self, name, interface, intra_index, stack_size):
+        self.name = name
+        self.interface = interface
+        self.intra_index = intra_index
+        self.stack_symbol = "_camkes_stack_%s" % name
+        self.stack_size = stack_size
+        self.ipc_symbol = "_camkes_ipc_buffer_%s" % name
+        self.sp = "get_vaddr(\'%s\') + %d" % (self.stack_symbol, self.stack_size + PAGE_SIZE)
+        self.addr = "get_vaddr(\'%s\') + %d" % (self.ipc_symbol, PAGE_SIZE)
+
 
 def threads(composition, instance, configuration, options):
     '''
@@ -280,18 +334,7 @@ def threads(composition, instance, configuration, options):
     assert isinstance(composition, Composition)
     assert isinstance(instance, Instance)
 
-    class Thread(object):
-        def __init__(self, name, interface, intra_index, stack_size):
-            self.name = name
-            self.interface = interface
-            self.intra_index = intra_index
-            self.stack_symbol = "_camkes_stack_%s" % name
-            self.stack_size = stack_size
-            self.ipc_symbol = "_camkes_ipc_buffer_%s" % name
-            self.sp = "get_vaddr(\'%s\') + %d" % (self.stack_symbol, self.stack_size + PAGE_SIZE)
-            self.addr = "get_vaddr(\'%s\') + %d" % (self.ipc_symbol, PAGE_SIZE)
-
-    instance_name = re.sub(r'[^A-Za-z0-9]', '_', instance.name)
+    instance_name = _NON_IDENTIFIER_CHARS.sub('_', instance.name)
     # First thread is control thread
     stack_size = configuration.get('_stack_size', options.default_stack_size)
     name = "%s_0_control" % instance_name
@@ -320,19 +363,30 @@ def threads(composition, instance, configuration, options):
     return ts
 
 
-def dataport_size(type):
+_DATAPORT_BUF = re.compile(r'Buf\((\d+)\)$')
+
+
+@memoize()
+def parse_dataport(type):
+    '''Returns the (size, type) pair of C expressions for a dataport type.'''
     assert isinstance(type, six.string_types)
-    m = re.match(r'Buf\((\d+)\)$', type)
+    m = _DATAPORT_BUF.match(type)
     if m is not None:
-        return m.group(1)
-    return 'sizeof(%s)' % show_type(type)
+        return m.group(1), 'void'
+    c_type = show_type(type)
+    return 'sizeof(%s)' % c_type, c_type
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('parse_dataport')
+
+
+def dataport_size(type):
+    return parse_dataport(type)[0]
 
 
 def dataport_type(type):
-    assert isinstance(type, six.string_types)
-    if re.match(r'Buf\((\d+)\)$', type) is not None:
-        return 'void'
-    return show_type(type)
+    return parse_dataport(type)[1]
 
 
 # The following macros are for when you require generation-time constant
@@ -371,16 +425,18 @@ _sizes = {
 
 
 def sizeof(arch, t):
-    assert isinstance(t, (Parameter,) + six.string_types)
-
     if isinstance(t, Parameter):
-        return sizeof(arch, t.type)
+        t = t.type
 
-    size = _sizes.get(t)
-    assert size is not None
-    return size
+    # Every key is a string, so this also rejects anything that is not a type
+    # name.
+    try:
+        return _sizes[t]
+    except KeyError:
+        raise AssertionError('unknown size of type %s' % t)
 
 
+@memoize()
 def get_word_size(arch):
     return int(lookup_architecture(arch).word_size_bits()/8)
 
@@ -449,10 +505,13 @@ def check_isabelle_outfile(thy_name, outfile_name):
     return ''
 
 
+_ISABELLE_IDENT = re.compile(r'^[a-zA-Z_](?:[a-zA-Z0-9_.]*[a-zA-Z0-9])?')
+
+
 def isabelle_ident(n):
     '''Mangle the '.' in hierarchical object names.
        This should match the mangling performed by capDL-tool.'''
-    assert re.match('^[a-zA-Z_](?:[a-zA-Z0-9_.]*[a-zA-Z0-9])?', n)
+    assert _ISABELLE_IDENT.match(n)
     return n.replace('.', '\'')
 
 
@@ -488,16 +547,42 @@ def integrity_group_labels(composition, configuration):
     '''
     group_labels = {}
 
+    # Labels that have already been looked up, mapped directly to the
+    # canonical label found for them (path compression). An entry may skip
+    # over any label on the original path, so they are all discarded when an
+    # existing label is reassigned. Adding a label is fine, as lookups carry
+    # on from the label an entry points to if that gains a group.
+    resolved = {}
+
+    def set_group_label(l, group):
+        if l in group_labels:
+            resolved.clear()
+        group_labels[l] = group
+
+    def cycle_error(l):
+        # Report the full path, without any shortcuts from `resolved`.
+        group = l
+        path = [l]
+        seen = set(path)
+        while group_labels[group] not in seen:
+            group = group_labels[group]
+            path.append(group)
+            seen.add(group)
+        return TemplateError('cycle in group labelling: %s' % ', '.join(path))
+
     # Helper to compute transitive closure
     def get_canonical_label(l):
         group = l
-        seen = [l]
+        path = [l]
+        seen = set(path)
         while group in group_labels:
-            group = group_labels[group]
+            group = resolved.get(group, group_labels[group])
             if group in seen:
-                raise TemplateError('cycle in group labelling: %s' %
-                                    ', '.join(seen))
-            seen.append(group)
+                raise cycle_error(l)
+            path.append(group)
+            seen.add(group)
+        for label in path[:-1]:
+            resolved[label] = group
         return group
 
     # 1. Groups
@@ -505,20 +590,20 @@ def integrity_group_labels(composition, configuration):
     # into address space identifiers, so we need to look there instead.
     for c in composition.instances:
         if c.address_space != c.name:
-            group_labels[c.name] = get_canonical_label(c.address_space)
+            set_group_label(c.name, get_canonical_label(c.address_space))
 
     # 2. Direct configuration
     for c in composition.instances:
         l = configuration[c.name].get('integrity_label')
         if l is not None:
-            group_labels[c.name] = get_canonical_label(l)
+            set_group_label(c.name, get_canonical_label(l))
 
     # 3. Internal connections
     for conn in composition.connections:
         groups = set(get_canonical_label(end.instance.name)
-                     for end in conn.from_ends + conn.to_ends)
+                     for end in itertools.chain(conn.from_ends, conn.to_ends))
         if len(groups) == 1:
-            group_labels[conn.name] = list(groups)[0]
+            set_group_label(conn.name, list(groups)[0])
 
     return {
         c: get_canonical_label(group)
@@ -526,6 +611,52 @@ def integrity_group_labels(composition, configuration):
     }
 
 
+# A weak reference to the composition that _instance_connections was last
+# built for, and the connections of each of its instances.
+_instance_connections = (None, {})
+
+
+def instance_connections(composition, instance):
+    '''
+    Returns the connections in the composition that have at least one end on
+    the given instance, in the order they appear in the composition.
+
+    The connections are indexed by instance name, so that helpers called once
+    per connection end do not each need to search every connection in the
+    system. The index is kept for the most recent composition as long as it is
+    frozen, as a frozen composition can no longer gain or lose connections.
+    This is always the case while rendering templates.
+    '''
+    global _instance_connections
+    ref, index = _instance_connections
+    if ref is None or ref() is not composition:
+        index = collections.defaultdict(list)
+        for c in composition.connections:
+            for name in set(e.instance.name for e in itertools.chain(c.from_ends, c.to_ends)):
+                index[name].append(c)
+        if composition.frozen:
+            _instance_connections = (weakref.ref(composition), index)
+    return index.get(instance.name, [])
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('instance_connections')
+
+
+@memoize()
+def badge_limit():
+    '''
+    Returns the smallest value that does not fit in a badge. This is looked up
+    on first use rather than at import, as libsel4 constants are only known
+    once the object sizes have been registered.
+    '''
+    return 2**get_libsel4_constant('seL4_Value_BadgeBits')
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('badge_limit')
+
+
 NO_CHECK_UNUSED.add('global_endpoint_badges')
 
 
@@ -543,23 +674,23 @@ def global_endpoint_badges(composition, end, configuration, arch):
     mechanism.
     '''
     def set_next_badge(next_badge, mask):
-        if (next_badge >= 2**get_libsel4_constant('seL4_Value_BadgeBits')):
+        # Each badge is a single bit, so the next badge is the lowest bit of
+        # the mask above the current one.
+        candidates = mask & -(next_badge << 1) if next_badge else mask
+        next_badge = candidates & -candidates
+        # Badges are found by shifting left one bit at a time, which fails
+        # once the value being shifted is outside the badge bits.
+        if not next_badge or next_badge >> 1 >= badge_limit():
             raise Exception("Couldn't allocate notification badge for %s" % end)
-        if next_badge == 0:
-            next_badge = 1
-        else:
-            next_badge = next_badge << 1
-        if not next_badge & mask:
-            next_badge = set_next_badge(next_badge, mask)
         return next_badge
 
     instance = end.instance
     base = configuration[instance.name].get("global_endpoint_base", 1)
     mask = configuration[instance.name].get(
-        "global_endpoint_mask", (2**get_libsel4_constant('seL4_Value_BadgeBits')-1) & (~base))
+        "global_endpoint_mask", (badge_limit()-1) & (~base))
     next_badge = set_next_badge(0, mask)
 
-    for c in composition.connections:
+    for c in instance_connections(composition, instance):
         if c.type.name in ["seL4DTBHardwareThreadless", "seL4DTBHWThreadless"] and instance in [to_end.instance for to_end in c.to_ends]:
             for to_end in c.to_ends:
                 if not configuration[str(to_end)].get("generate_interrupts", False):
@@ -608,7 +739,7 @@ def global_rpc_endpoint_badges(composition, end, configuration):
     mechanism.
     '''
     def set_next_badge(next_badge, mask):
-        if (next_badge >= min(2**get_libsel4_constant('seL4_Value_BadgeBits'), mask)):
+        if (next_badge >= min(badge_limit(), mask)):
             raise Exception("Couldn't allocate endpoint badge for %s" % end)
         if not ((next_badge & mask) == next_badge):
             # If the badge has some bits that the mask doesn't allow, add them on.
@@ -620,10 +751,10 @@ def global_rpc_endpoint_badges(composition, end, configuration):
     instance = end.instance
     base = configuration[instance.name].get("global_rpc_endpoint_base", 0)
     mask = configuration[instance.name].get(
-        "global_rpc_endpoint_mask", 2**get_libsel4_constant('seL4_Value_BadgeBits')-2)
+        "global_rpc_endpoint_mask", badge_limit()-2)
     next_badge = set_next_badge(1, mask)
     badges = []
-    for c in composition.connections:
+    for c in instance_connections(composition, instance):
         if c.type.get_attribute("from_global_rpc_endpoint") and c.type.get_attribute("from_global_rpc_endpoint").default:
             for i in c.from_ends:
                 if i.instance is instance:
@@ -666,27 +797,114 @@ def virtqueue_get_client_id(composition, end, configuration):
 
     connections = []
     ids = []
-    for c in composition.connections:
+    for c in instance_connections(composition, instance):
         if c.type.name == "seL4VirtQueues":
-            for i in c.from_ends + c.to_ends:
+            for i in itertools.chain(c.from_ends, c.to_ends):
                 if i.instance is instance:
                     connections.append(i)
                     ids.append(configuration[instance.name].get("%s_id" % i.interface.name))
-    current_id = 0
-    for index, c in enumerate(connections):
-        if ids[index] is None:
-            for _ in ids:
-                if current_id not in ids:
-                    ids[index] = current_id
-                    current_id += 1
-                    break
-                current_id += 1
+    taken = set(ids)
+    free_ids = (i for i in itertools.count() if i not in taken)
+    for index, client_id in enumerate(ids):
+        if client_id is None:
+            ids[index] = next(free_ids)
     return ids[connections.index(end)]
 
 
 NO_CHECK_UNUSED.add('parse_dtb_node_interrupts')
 
 
+class Irq(collections.namedtuple('Irq', ('irq', 'trigger'))):
+    '''
+    An interrupt parsed from a devicetree node. These used to be dicts, so the
+    fields can also be looked up by name, e.g. irq['irq']. Nothing else of the
+    dict interface is supported: `in`, len() and iteration behave as for a
+    tuple, and there is no get(), keys() or items().
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, six.string_types):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return super(Irq, self).__getitem__(key)
+
+
+# The offsets of the id, flags and type values within each interrupt, for
+# each supported number of values per interrupt. None if a value is absent.
+_INTERRUPT_CELL_OFFSETS = {
+    1: (0, None, None),
+    3: (1, 2, 0),
+}
+
+
+def parse_interrupts_1_cell(interrupts):
+    '''
+    Build the interrupts from devicetree values in the 1-value-format. There
+    are no flags, so the interrupts are assumed to be edge triggered.
+    '''
+    return [Irq(irq=irq, trigger=1) for irq in interrupts]
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('parse_interrupts_1_cell')
+
+
+def parse_interrupts_3_cells(interrupts):
+    '''
+    Build the interrupts from devicetree values in the 3-value-format. This is
+    not used on ARM, so the type of each interrupt is ignored.
+    '''
+    # The 'flags' are defined as:
+    #   bit 0: low-to-high edge triggered
+    #   bit 1: high-to-low edge triggered
+    #   bit 2: active high level-sensitive
+    #   bit 3: active low level-sensitive
+    #   bits 8 - 15: for PPI interrupts this holds the PPI interrupt
+    #                core mask, each bit corresponds to each of the 8
+    #                possible core attached to the GIC,a '1' indicates
+    #                the interrupt is wired to that core.
+    return [Irq(irq=irq, trigger=int(0 != (irq_flags & 0x3)))
+            for irq, irq_flags in zip(interrupts[1::3], interrupts[2::3])]
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('parse_interrupts_3_cells')
+
+
+def raise_bad_interrupt_cell(interrupts, interrupt_cells):
+    '''
+    Raise an error for the first devicetree interrupt value that is not a
+    number, going through the values of each interrupt in turn.
+    '''
+    num_interrupts = len(interrupts) // interrupt_cells
+    offsets = zip(_INTERRUPT_CELL_OFFSETS[interrupt_cells],
+                  ('id', 'trigger', 'type'))
+    offsets = [(offs, name) for offs, name in offsets if offs is not None]
+    for i in range(0, num_interrupts):
+        for offs, name in offsets:
+            idx = (i * interrupt_cells) + offs
+            val = interrupts[idx]
+            if not isinstance(val, numbers.Integral):
+                raise TemplateError(
+                    'Error parsing interrupt {}/{} (cells={}, idx={}): '
+                    '{} "{}" is not a number'.format(
+                        i+1, num_interrupts, interrupt_cells, idx, name, val))
+
+
+# This is just an internal helper
+NO_CHECK_UNUSED.add('raise_bad_interrupt_cell')
+
+
+# How to build the interrupts for each supported number of values per
+# interrupt.
+_PARSE_INTERRUPT_CELLS = {
+    1: parse_interrupts_1_cell,
+    3: parse_interrupts_3_cells,
+}
+
+
 def parse_dtb_node_interrupts(node, max_num_interrupts, arch):
 
     # Interrupts can be described in these formats:
@@ -724,22 +942,20 @@ def parse_dtb_node_interrupts(node, max_num_interrupts, arch):
             else:
                 num_interrupts = len(interrupts)//3
             if max_num_interrupts != -1 and num_interrupts > max_num_interrupts:
-                raise TemplateError('Device has more than %d interrupts, this is more than we can support.') % (
-                    max_num_interrupts)
-            for i in range(0, num_interrupts):
-                if is_extended_interrupts:
-                    # Same as below, but ignores the first field in the list
-                    _trigger = interrupts[i*3+3]
-                    _irq = interrupts[i*3+2]
-                    _irq_spi = interrupts[i*3+1]
-                else:
-                    _trigger = interrupts[i*3+2]
-                    _irq = interrupts[i*3+1]
-                    _irq_spi = interrupts[i*3+0]
-                if (isinstance(_irq_spi, numbers.Integral) and (_irq_spi == 0)):
+                raise TemplateError('Device has more than %d interrupts, this '
+                                    'is more than we can support.' %
+                                    max_num_interrupts)
+            # Extended interrupts are the same, but ignore the first field in
+            # the list.
+            offset = 1 if is_extended_interrupts else 0
+            cells = interrupts[offset:offset + num_interrupts * 3]
+            for _irq_spi, _irq, _trigger in zip(cells[0::3], cells[1::3], cells[2::3]):
+                # Shared peripheral interrupts (type 0) are offset by 32. The
+                # comparison is cheaper than the type check, so it goes first.
+                if (_irq_spi == 0) and isinstance(_irq_spi, numbers.Integral):
                     _irq = _irq + 32
-                _trigger = 1 if _trigger < 4 else 0
-                irq_set.append({'irq': _irq, 'trigger': _trigger})
+                _trigger = int(_trigger < 4)
+                irq_set.append(Irq(_irq, _trigger))
         return irq_set
 
     # For non-ARM architectures (currently that means RISC-V) try using a more
@@ -775,60 +991,11 @@ def parse_dtb_node_interrupts(node, max_num_interrupts, arch):
             'Peripheral has {} interrupts, max. {} are supported'.format(
                 num_interrupts, max_num_interrupts))
 
-    irq_set = []
-
-    for i in range(0, num_interrupts):
+    # Check that all the values are numbers in a single pass. Devicetree cells
+    # are decoded as plain ints, so check for that first before falling back
+    # to the much slower ABC check.
+    if not all(type(val) is int or isinstance(val, numbers.Integral)
+               for val in interrupts):
+        raise_bad_interrupt_cell(interrupts, interrupt_cells)
 
-        def parse_int(offs, name):
-            idx = (i * interrupt_cells) + offs
-            val = interrupts[idx]
-            if not isinstance(val, numbers.Integral):
-                raise TemplateError(
-                    'Error parsing interrupt {}/{} (cells={}, idx={}): '
-                    '{} "{}" is not a number'.format(
-                        i+1, num_interrupts, interrupt_cells, idx, name, val))
-            return val
-
-        offs_irq = 1 if (3 == interrupt_cells) \
-            else 0 if (1 == interrupt_cells) \
-            else None
-        assert (offs_irq is not None)
-        irq = parse_int(offs_irq, 'id')
-
-        offs_flags = 2 if (3 == interrupt_cells) else None
-        irq_flags = None if offs_flags is None \
-            else parse_int(offs_flags, 'trigger')
-
-        offs_spi = 0 if (3 == interrupt_cells) else None
-        irq_type = None if offs_spi is None \
-            else parse_int(offs_spi, 'type')
-
-        # Process the interrupt details.
-        #
-        # The 'flags' are defined as:
-        #   bit 0: low-to-high edge triggered
-        #   bit 1: high-to-low edge triggered
-        #   bit 2: active high level-sensitive
-        #   bit 3: active low level-sensitive
-        #   bits 8 - 15: for PPI interrupts this holds the PPI interrupt
-        #                core mask, each bit corresponds to each of the 8
-        #                possible core attached to the GIC,a '1' indicates
-        #                the interrupt is wired to that core.
-        # Assume edge triggered interrupt if no flags are present.
-        is_edge_triggered = ((irq_flags is None) or (0 != (irq_flags & 0x3)))
-
-        # The 'type' is only relevant on ARM, for all other architectures we
-        # ignore this value.
-        #   0: shared peripheral interrupt (SPI) where the actual interrupt
-        #      value is 'irq + 32'
-        #   1: private peripheral interrupt (PPI)
-        is_arm_spi = ((irq_type is not None) and is_arch_arm(arch) and
-                      (0 == irq_type))
-
-        # Add an interrupt descriptor to the list.
-        irq_set.append({
-            'irq':     (irq + 32) if is_arm_spi else irq,
-            'trigger': 1 if is_edge_triggered else 0
-        })
-
-    return irq_set
+    return _PARSE_INTERRUPT_CELLS[interrupt_cells](interrupts)
@@ -122,7 +122,7 @@
 
     /*- for (i, irq_node) in enumerate(irq_set)  -*/
 
-        /*- set _irq = irq_node['irq'] -*/
+        /*- set _irq = irq_node.irq -*/
 
         /*- set interrupt_ntfn = Cap(ntfn_obj, read=True, write=True, badge=pow(2, i)) -*/
 
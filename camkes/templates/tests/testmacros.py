@@ -15,6 +15,8 @@ from __future__ import absolute_import, division, print_function, \
     unicode_literals
 
 import ast, fnmatch, os, re, subprocess, sys, unittest
+import itertools
+import six
 
 ME = os.path.abspath(__file__)
 MY_DIR = os.path.dirname(ME)
@@ -27,8 +29,22 @@ sys.path.append(os.path.join(MY_DIR, '../../../../python-capdl'))
 sys.path.append(os.path.join(MY_DIR, '../../..'))
 
 from camkes.internal.tests.utils import CAmkESTest, which
-from camkes.templates.macros import NO_CHECK_UNUSED, get_perm
-from camkes.templates import TemplateError
+from camkes.parser.stage0 import Reader
+from camkes.parser.stage1 import Parse1
+from camkes.parser.stage2 import Parse2
+from camkes.parser.stage3 import Parse3
+from camkes.parser.stage4 import Parse4
+from camkes.parser.stage5 import Parse5
+from camkes.parser.stage6 import Parse6
+from camkes.parser.stage7 import Parse7
+from camkes.parser.stage8 import Parse8
+from camkes.parser.stage9 import Parse9
+from camkes.parser.stage10 import Parse10
+from camkes.templates.macros import NO_CHECK_UNUSED, get_perm, \
+    get_untypeds_from_range, global_endpoint_badges, instance_connections, \
+    integrity_group_labels, next_page_multiple, parse_dtb_node_interrupts, \
+    virtqueue_get_client_id
+from camkes.templates import macros, TemplateError
 
 def uname():
     '''
@@ -44,6 +60,24 @@ def uname():
     return machine
 
 class TestMacros(CAmkESTest):
+    def setUp(self):
+        super(TestMacros, self).setUp()
+        r = Reader()
+        s1 = Parse1(r)
+        s2 = Parse2(s1)
+        s3 = Parse3(s2, debug=True)
+        s4 = Parse4(s3)
+        s5 = Parse5(s4)
+        s6 = Parse6(s5)
+        s7 = Parse7(s6)
+        s8 = Parse8(s7)
+        # Stage 10 freezes the AST, so stage 9 gives one that can be changed.
+        self.unfrozen_parser = Parse9(s8)
+        self.parser = Parse10(self.unfrozen_parser)
+
+    def parse_assembly(self, spec, parser=None):
+        ast, _ = (parser or self.parser).parse_string(spec)
+        return ast.items[-1]
 
     def test_get_perm(self):
         conf = {}
@@ -55,10 +89,301 @@ class TestMacros(CAmkESTest):
         self.assertEqual(get_perm(conf, instance, iface), "RWXP")
         conf[instance][field] = "R"
         self.assertEqual(get_perm(conf, instance, iface), "R")
+        conf[instance][field] = "RWP"
+        self.assertEqual(get_perm(conf, instance, iface), "RWP")
+        conf[instance][field] = "WR"
+        with self.assertRaises(TemplateError):
+            get_perm(conf, instance, iface)
         conf[instance][field] = "FOO"
         with self.assertRaises(TemplateError):
             get_perm(conf, instance, iface)
 
+    def test_next_page_multiple(self):
+        self.assertEqual(next_page_multiple(0, 'x86_64'), 4096)
+        self.assertEqual(next_page_multiple(4096, 'x86_64'), 4096)
+        self.assertEqual(next_page_multiple(4097, 'x86_64'), 8192)
+        self.assertEqual(next_page_multiple(0x100000, 'x86_64'), 0x100000)
+        self.assertEqual(next_page_multiple(0x100001, 'x86_64'), 0x101000)
+
+    def test_get_untypeds_from_range(self):
+        self.assertEqual(get_untypeds_from_range(0x1000, 0x1000),
+                         [(0x1000, 12)])
+        self.assertEqual(get_untypeds_from_range(0x3000, 0x6000),
+                         [(0x3000, 12), (0x4000, 14), (0x8000, 12)])
+        self.assertEqual(get_untypeds_from_range(0, 0x5000),
+                         [(0, 14), (0x4000, 12)])
+
+    def test_instance_connections(self):
+        spec = '''
+            connector C {
+                from Procedure;
+                to Procedure;
+            }
+            procedure P {}
+            component Server {
+                provides P p1;
+                provides P p2;
+            }
+            component Client {
+                uses P p;
+            }
+            assembly {
+                composition {
+                    component Server s;
+                    component Client c1;
+                    component Client c2;
+                    connection C conn1(from c1.p, to s.p1);
+                    connection C conn2(from c2.p, to s.p2);
+                }
+            }
+            '''
+        a1 = self.parse_assembly(spec)
+        a2 = self.parse_assembly(spec)
+        c1, = [i for i in a1.composition.instances if i.name == 'c1']
+        c2, = [i for i in a2.composition.instances if i.name == 'c2']
+
+        # Each composition is indexed on its own, even though they are equal.
+        self.assertEqual([c.name for c in instance_connections(
+            a1.composition, c1)], ['conn1'])
+        self.assertIs(instance_connections(a2.composition, c2)[0],
+                      a2.composition.connections[1])
+        self.assertIs(instance_connections(a1.composition, c1)[0],
+                      a1.composition.connections[0])
+
+        # A composition that is not frozen yet is indexed afresh each time.
+        a3 = self.parse_assembly(spec, self.unfrozen_parser)
+        s, = [i for i in a3.composition.instances if i.name == 's']
+        self.assertEqual([c.name for c in instance_connections(
+            a3.composition, s)], ['conn1', 'conn2'])
+        a3.composition.connections.pop()
+        self.assertEqual([c.name for c in instance_connections(
+            a3.composition, s)], ['conn1'])
+
+    def test_global_endpoint_badges(self):
+        # Use a fixed badge width without changing the object sizes registered
+        # with CapDL, and make sure it is what the badge limit is computed from.
+        get_libsel4_constant = macros.get_libsel4_constant
+        macros.get_libsel4_constant = {'seL4_Value_BadgeBits': 28}.__getitem__
+        self.addCleanup(setattr, macros, 'get_libsel4_constant',
+                        get_libsel4_constant)
+        macros.badge_limit.cache_clear()
+        self.addCleanup(macros.badge_limit.cache_clear)
+
+        spec = '''
+            connector N {
+                from Events;
+                to Event;
+                attribute int to_global_endpoint = 1;
+            }
+            component Client {
+                emits E e;
+            }
+            component Server {
+                consumes E a;
+                consumes E b;
+                consumes E c;
+            }
+            assembly {
+                composition {
+                    component Client c1;
+                    component Client c2;
+                    component Client c3;
+                    component Server s;
+                    connection N n1(from c1.e, to s.a);
+                    connection N n2(from c2.e, to s.b);
+                    connection N n3(from c3.e, to s.c);
+                }
+                configuration {
+                    %s
+                }
+            }
+            '''
+
+        def badges(configuration, count=3):
+            # The badges of the server's ends of the first `count` connections.
+            assembly = self.parse_assembly(spec % configuration)
+            return [global_endpoint_badges(assembly.composition, c.to_ends[0],
+                                           assembly.configuration, 'x86_64')
+                    for c in assembly.composition.connections[:count]]
+
+        # By default, each badge is the next bit up from the base.
+        self.assertEqual(badges(''), [0x3, 0x5, 0x9])
+
+        # Badges skip the bits the mask leaves out.
+        self.assertEqual(badges('s.global_endpoint_mask = 0x1a0;'),
+                         [0x21, 0x81, 0x101])
+        self.assertEqual(badges('s.global_endpoint_mask = 0x110;'
+                                's.global_endpoint_base = 0x1000;', 2),
+                         [0x1010, 0x1100])
+
+        # Running out of mask bits is an error.
+        self.assertEqual(badges('s.global_endpoint_mask = 0x11;', 2),
+                         [0x1, 0x11])
+        with six.assertRaisesRegex(self, Exception,
+                                   r'^Couldn\'t allocate notification badge for s\.c$'):
+            badges('s.global_endpoint_mask = 0x11;')
+
+        # So is running into mask bits that are beyond the badge bits.
+        self.assertEqual(badges('s.global_endpoint_mask = 0x64000000;', 1),
+                         [0x4000001])
+        with six.assertRaisesRegex(self, Exception,
+                                   r'^Couldn\'t allocate notification badge for s\.b$'):
+            badges('s.global_endpoint_mask = 0x64000000;', 2)
+
+    def test_virtqueue_get_client_id(self):
+        spec = '''
+            connector seL4VirtQueues {
+                from Dataport;
+                to Dataport;
+            }
+            component Driver {
+                dataport Buf d0;
+                dataport Buf d1;
+                dataport Buf d2;
+                dataport Buf d3;
+            }
+            component Client {
+                dataport Buf d;
+            }
+            assembly {
+                composition {
+                    component Driver drv;
+                    component Client c0;
+                    component Client c1;
+                    component Client c2;
+                    component Client c3;
+                    connection seL4VirtQueues v0(from drv.d0, to c0.d);
+                    connection seL4VirtQueues v1(from c1.d, to drv.d1);
+                    connection seL4VirtQueues v2(from drv.d2, to c2.d);
+                    connection seL4VirtQueues v3(from drv.d3, to c3.d);
+                }
+                configuration {
+                    %s
+                }
+            }
+            '''
+
+        def ids(configuration):
+            assembly = self.parse_assembly(spec % configuration)
+            composition = assembly.composition
+            return [virtqueue_get_client_id(composition, e,
+                                            assembly.configuration)
+                    for c in composition.connections
+                    for e in itertools.chain(c.from_ends, c.to_ends)
+                    if e.instance.name == 'drv']
+
+        self.assertEqual(ids(''), [0, 1, 2, 3])
+
+        # Unconfigured ends take the lowest IDs that are not configured for
+        # another end, leaving holes where a configured ID is out of range.
+        self.assertEqual(ids('drv.d1_id = 0; drv.d3_id = 2;'), [1, 0, 3, 2])
+        self.assertEqual(ids('drv.d1_id = 5; drv.d2_id = 1;'), [0, 5, 1, 2])
+
+    def test_integrity_group_labels(self):
+        spec = '''
+            connector C {
+                from Procedure;
+                to Procedure;
+            }
+            procedure P {}
+            component Server {
+                provides P p;
+            }
+            component Client {
+                uses P u;
+            }
+            component Other {}
+            assembly {
+                composition {
+                    component Client b;
+                    component Other c;
+                    component Other x;
+                    group g {
+                        component Server a;
+                    }
+                    connection C conn(from b.u, to g.a.p);
+                }
+                configuration {
+                    %s
+                }
+            }
+            '''
+
+        def labels(configuration):
+            assembly = self.parse_assembly(spec % configuration)
+            return integrity_group_labels(assembly.composition,
+                                          assembly.configuration)
+
+        self.assertEqual(labels(''), {'a': 'g'})
+        self.assertEqual(labels('b.integrity_label = "a";'),
+                         {'a': 'g', 'b': 'g', 'conn': 'g'})
+
+        # b is looked up through a before a's group label is replaced by its
+        # own integrity label, so a must not still be taken to be in g.
+        self.assertEqual(labels('b.integrity_label = "a";'
+                                'a.integrity_label = "x";'),
+                         {'a': 'x', 'b': 'g'})
+
+        with six.assertRaisesRegex(self, TemplateError,
+                                   r'^cycle in group labelling: b, c$'):
+            labels('b.integrity_label = "c"; c.integrity_label = "b";')
+        with six.assertRaisesRegex(self, TemplateError,
+                                   r'^cycle in group labelling: b, c, x$'):
+            labels('b.integrity_label = "c"; c.integrity_label = "x";'
+                   'x.integrity_label = "b";')
+
+    def test_parse_dtb_node_interrupts(self):
+        def irqs(node, arch, max_num_interrupts=-1):
+            parsed = parse_dtb_node_interrupts(node, max_num_interrupts, arch)
+            # The templates look the fields up by name as well as attribute.
+            for i in parsed:
+                self.assertEqual(i['irq'], i.irq)
+                self.assertEqual(i['trigger'], i.trigger)
+            return [(i.irq, i.trigger) for i in parsed]
+
+        # Like the dicts these used to be, only the fields can be looked up.
+        irq, = parse_dtb_node_interrupts({'interrupts': [10]}, -1, 'riscv64')
+        for key in ('count', 'index', '_fields', 'type'):
+            with self.assertRaises(KeyError):
+                irq[key]
+
+        self.assertEqual(irqs({}, 'aarch64'), [])
+        self.assertEqual(irqs({}, 'riscv64'), [])
+
+        # On ARM, interrupts always have a type, id and flags. Shared
+        # peripheral interrupts (type 0) are offset by 32 and only level
+        # triggered interrupts (flags of 4 or more) are not edge triggered.
+        cells = [0, 5, 4, 1, 6, 1]
+        self.assertEqual(irqs({'interrupts': cells}, 'aarch64'),
+                         [(37, 0), (6, 1)])
+        self.assertEqual(irqs({'interrupts_extended': [0x10] + cells[:3]},
+                              'arm_hyp'), [(37, 0)])
+        with six.assertRaisesRegex(self, TemplateError,
+                                   r'^Device has more than 1 interrupts'):
+            irqs({'interrupts': cells}, 'aarch32', 1)
+
+        # Elsewhere the number of values per interrupt is guessed, the type is
+        # ignored and only the edge triggered flags are considered.
+        self.assertEqual(irqs({'interrupts': [10]}, 'riscv64'), [(10, 1)])
+        self.assertEqual(irqs({'interrupts': [10, 11]}, 'riscv64'),
+                         [(10, 1), (11, 1)])
+        self.assertEqual(irqs({'interrupts': cells}, 'riscv64'),
+                         [(5, 0), (6, 1)])
+        self.assertEqual(irqs({'interrupts_extended': [0x10, 3]}, 'riscv32'),
+                         [(3, 1)])
+        self.assertEqual(irqs({'interrupts_extended': [0x10]}, 'riscv32'), [])
+
+        with six.assertRaisesRegex(self, TemplateError,
+                                   r'^Found 4 values, but expecting 3 per interrupt$'):
+            irqs({'interrupts': [1, 2, 3, 4]}, 'riscv64')
+        with six.assertRaisesRegex(self, TemplateError,
+                                   r'^Peripheral has 2 interrupts, max\. 1 are supported$'):
+            irqs({'interrupts': [10, 11]}, 'riscv64', 1)
+        with six.assertRaisesRegex(self, TemplateError,
+                                   r'^Error parsing interrupt 2/2 \(cells=3, idx=5\): '
+                                   r'trigger "x" is not a number$'):
+            irqs({'interrupts': [0, 5, 4, 'x', 6, 'x']}, 'riscv64')
+
     def test_find_unused_macros(self):
         '''
         Find macros intended for the templates that are never actually used in